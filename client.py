@@ -1,4 +1,13 @@
 import socket
+import struct
+
+# Set to True to print a message for every request sent to the Pico.
+DEBUG = False
+
+
+# Big-endian 2 and 4 byte unsigned ints, used for delays and lengths
+_H = struct.Struct('>H')
+_I = struct.Struct('>I')
 
 """
     This class provides a way for other applications to integrate with
@@ -42,17 +51,8 @@ class PicoGpioNetClient:
     CMD_GET_NAME = 7
     CMD_GET_API_VERSION = 8
 
-    # Socket connection
-    sock = False
-
-    # Outgoing data queue
-    queue = bytearray()
-
-    # Size of queue
-    queueCount = 0
-
-    # Whether to flush the queue automatically or not
-    autoFlush = False
+    # Instance attributes, which are set up in __init__
+    __slots__ = ('sock', 'queue', 'queueCount', 'autoFlush')
 
     """
         ip: ip address of the Pico server to connect to
@@ -63,9 +63,31 @@ class PicoGpioNetClient:
         If False, queue up commands until .flush() is called.
     """
     def __init__(self, ip, port, autoFlush = False):
+
+        # Whether to flush the queue automatically or not
         self.autoFlush = autoFlush
+
+        # Outgoing data queue
+        self.queue = bytearray()
+
+        # Number of requests in the queue
+        self.queueCount = 0
+
+        # Socket connection
+        self.sock = False
+
         sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_IP, socket.IP_TTL, 1)
+
+        # Disable Nagle's algorithm.
+        # Requests are tiny and we already batch them up in the queue,
+        # so there's no point letting the kernel hold onto them.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # Make the kernel buffers big enough to hold a typical flush,
+        # so that large writes aren't broken up into lots of small ones.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 64 * 1024)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
         sock.connect((ip, port))
         self.sock = sock
 
@@ -84,27 +106,65 @@ class PicoGpioNetClient:
     """
         Flushes the queue.
         This sends all pending requests to the server in one go.
-        It then receives (and discards) all of the server responses.
+        It then receives all of the server responses, and raises an
+        IOError if any of the requests failed.
     """
     def flush(self):
         if self.queueCount == 0:
             return
-        print(f"Flushing: {self.queueCount}")
-        self.sock.send(self.queue)
-        results = []
-        result = bytearray()
-        while len(result) < self.queueCount:
-            diff = self.queueCount - len(result)
-            #print(f"Reading {diff} more bytes")
-            result.extend(self.sock.recv(diff))
-        #print(f"Received: {result}")
-        expected = b'\x01'
-        for i in range(0, self.queueCount):
-            success = result[i] == 1
-            #print(f"Result {i}: {success}")
-            results.append(success)
-        self.queue = bytearray()
-        self.queueCount = 0
+        if DEBUG:
+            print(f"Flushing: {self.queueCount}")
+        self.send_queue(self.queueCount, 0)
+
+    """
+        Sends the whole queue to the server with sendall, then
+        reads back one ack byte per queued write request, followed
+        by `extraLength` bytes of response data.
+
+        The queue is emptied afterwards, even if a request failed,
+        since the server has already run every command in it.
+
+        `ackCount` Number of write requests in the queue, each of which
+        sends back a single ack byte
+        `extraLength` Number of bytes expected after the acks. This is
+        non-zero when the last command in the queue is a read request.
+
+        Returns the trailing `extraLength` bytes.
+    """
+    def send_queue(self, ackCount, extraLength):
+        self.sock.sendall(self.queue)
+        try:
+            result = self.recv_exactly(ackCount + extraLength)
+            #print(f"Received: {result}")
+
+            # Every write request should have been acknowledged with a 1
+            if result.count(1, 0, ackCount) != ackCount:
+                raise IOError('Server reported a failed request')
+        finally:
+            # Don't send the same commands again on the next flush
+            self.queue = bytearray()
+            self.queueCount = 0
+        return result[ackCount:]
+
+    """
+        Reads exactly `length` bytes from the socket.
+
+        recv may return fewer bytes than requested, so keep reading
+        until we have everything. Data is received straight into a
+        preallocated bytearray, rather than allocating a new bytes
+        object for every recv call.
+    """
+    def recv_exactly(self, length):
+        result = bytearray(length)
+        view = memoryview(result)
+        received = 0
+        while received < length:
+            #print(f"Reading {length - received} more bytes")
+            n = self.sock.recv_into(view[received:], length - received)
+            if n == 0:
+                raise ConnectionError('Socket connection closed')
+            received += n
+        return result
 
     """
         Queues up an arbitrary write request.
@@ -115,28 +175,36 @@ class PicoGpioNetClient:
         doesn't provide any further insight into the operation
         beyond that.
 
-        `cmd` Array of bytes to send
+        `cmd` Bytes-like object to send
     """
     def do_write_request(self, cmd):
-        self.queue.extend(bytearray(cmd))
+        self.queue.extend(cmd)
         self.queueCount += 1
         #print(f"Queue count: {self.queueCount}")
         if self.autoFlush:
         	self.flush()
 
     """
-        Performs a read request after flushing the queue, if needed.
+        Performs a read request.
+
+        The read request is appended to the end of the queue, and the
+        whole queue is sent in one go. That way any pending write
+        requests and the read request share a single send and
+        receive, rather than flushing first and then sending the read
+        request separately.
 
         A read request is one which expects a meaningful response.
         For example, reading data from SPI, or reading a pin's state.
 
-        `cmd` Array of bytes to send
+        `cmd` Bytes-like object to send
         `length` Expected length of the response from the server
     """
     def do_read_request(self, cmd, length):
-        self.flush()
-        self.sock.send(bytearray(cmd))
-        return self.sock.recv(length)
+        # Every request already in the queue is a write request
+        ackCount = self.queueCount
+        self.queue.extend(cmd)
+        self.queueCount += 1
+        return self.send_queue(ackCount, length)
 
     """
         Sets the state of a single pin.
@@ -145,7 +213,7 @@ class PicoGpioNetClient:
         `value` New value to set for the pin
     """
     def set_pin(self, pin, value):
-        cmd = [self.CMD_SET_PIN_SINGLE, pin, value]
+        cmd = bytes((self.CMD_SET_PIN_SINGLE, pin, value))
         return self.do_write_request(cmd)
 
     """
@@ -157,9 +225,10 @@ class PicoGpioNetClient:
     """
     def set_pins(self, pinsAndValues):
         numberOfPins = len(pinsAndValues)
-        cmd = [self.CMD_SET_PIN_MULTI, numberOfPins]
+        cmd = bytearray((self.CMD_SET_PIN_MULTI, numberOfPins))
         for (pin, value) in pinsAndValues:
-            cmd.extend([pin, value])
+            cmd.append(pin)
+            cmd.append(value)
         return self.do_write_request(cmd)
 
     """
@@ -171,8 +240,9 @@ class PicoGpioNetClient:
     """
     def get_pin(self, pin):
         numberOfPins = 1
-        print(f"Get pin {pin}")
-        cmd = [self.CMD_GET_PIN_SINGLE, pin]
+        if DEBUG:
+            print(f"Get pin {pin}")
+        cmd = bytes((self.CMD_GET_PIN_SINGLE, pin))
         return self.do_read_request(cmd, 1)
 
     """
@@ -187,8 +257,9 @@ class PicoGpioNetClient:
     """
     def get_pins(self, pins):
         numberOfPins = len(pins)
-        print(f"Getting {numberOfPins} pins")
-        cmd = [self.CMD_GET_PIN_MULTI, numberOfPins, *pins]
+        if DEBUG:
+            print(f"Getting {numberOfPins} pins")
+        cmd = bytes((self.CMD_GET_PIN_MULTI, numberOfPins)) + bytes(pins)
         return self.do_read_request(cmd, numberOfPins)
 
     """
@@ -197,11 +268,15 @@ class PicoGpioNetClient:
         `bytedata` Array of bytes to write to the SPI device
     """
     def write_bytes(self, bytedata):
-        print("Pico write bytes")
-        print(f"Length: {len(bytedata)}")
-        lengthBytes = len(bytedata).to_bytes(4, 'big')
-        cmd = [self.CMD_WRITE_BYTES, *lengthBytes, *bytedata]
-        return self.do_write_request(cmd)
+        if DEBUG:
+            print("Pico write bytes")
+            print(f"Length: {len(bytedata)}")
+        # Queue the header separately from the data, so that the data
+        # can be copied straight into the queue without first being
+        # unpacked into a list.
+        header = bytes((self.CMD_WRITE_BYTES,)) + _I.pack(len(bytedata))
+        self.queue.extend(header)
+        return self.do_write_request(bytedata)
 
     """
         Tells the Pico server to wait for a defined amount of time
@@ -226,10 +301,12 @@ class PicoGpioNetClient:
         `delay_ms` Time to wait in milliseconds
     """
     def delay(self, delay_ms):
-        print(f"Sending delay of {delay_ms}")
-        delayBytes = delay_ms.to_bytes(2, 'big')
-        cmd = [self.CMD_DELAY, *delayBytes]
-        print(f"Sending {cmd}")
+        if DEBUG:
+            print(f"Sending delay of {delay_ms}")
+        delayBytes = _H.pack(delay_ms)
+        cmd = bytes((self.CMD_DELAY,)) + delayBytes
+        if DEBUG:
+            print(f"Sending {cmd}")
         return self.do_write_request(cmd)
 
     """
@@ -248,9 +325,10 @@ class PicoGpioNetClient:
         `delay_ms` Milliseconds to wait between pin reads 
     """
     def wait_for_pin(self, pin, value, delay_ms):
-        print("Sending delay")
-        delayBytes = delay_ms.to_bytes(2, 'big')
-        cmd = [self.CMD_WAIT_FOR_PIN, pin, value, *delayBytes]
+        if DEBUG:
+            print("Sending delay")
+        delayBytes = _H.pack(delay_ms)
+        cmd = bytes((self.CMD_WAIT_FOR_PIN, pin, value)) + delayBytes
         return self.do_write_request(cmd)
 
     """
@@ -262,11 +340,12 @@ class PicoGpioNetClient:
         Command introduced in API version 2.
     """
     def get_name(self):
-        print("Getting device name")
-        cmd = [self.CMD_GET_NAME]
+        if DEBUG:
+            print("Getting device name")
+        cmd = bytes((self.CMD_GET_NAME,))
         lengthBytes = self.do_read_request(cmd, 1)
         length = int.from_bytes(lengthBytes)
-        nameBytes = self.sock.recv(length)
+        nameBytes = self.recv_exactly(length)
         return nameBytes.decode()
 
     """
@@ -282,7 +361,8 @@ class PicoGpioNetClient:
         response for an unknown command is [1].
     """
     def get_api_version(self):
-        print(f"Getting API version")
-        cmd = [self.CMD_GET_API_VERSION]
-        bytes = self.do_read_request(cmd, 1)
-        return int.from_bytes(bytes)
+        if DEBUG:
+            print("Getting API version")
+        cmd = bytes((self.CMD_GET_API_VERSION,))
+        versionBytes = self.do_read_request(cmd, 1)
+        return int.from_bytes(versionBytes)
@@ -1,6 +1,10 @@
 import socket
+import select
 from time import sleep
 
+# Set to True to print a message for every command and socket read.
+DEBUG = False
+
 
 ### Change these variables to suit your application
 
@@ -24,21 +28,54 @@ class PicoGpioNetDaemon():
     CMD_GET_NAME = 7
     CMD_GET_API_VERSION = 8
 
+    MIN_RECV_CHUNK = 512
+    NUM_PINS = 30
+    _PIN_RESPONSES = (b'\x00', b'\x01')
 
 
-    def __init__(self, ssid, password, maxSizeKb, name):
+    def __init__(self, ssid, password, maxSizeKb, name, recvChunk = 2048, outPins = (), inPins = (), spiBaudrate = 24_000_000):
         self.ssid = ssid
         self.password = password
         self.name = name
+        self.spi_baudrate = spiBaudrate
+        self.out_pins = outPins
+        self.in_pins = inPins
         self.max_read_size = 1024 * maxSizeKb
-        self.buffer = bytearray()
+        self.recv_chunk = max(min(self.max_read_size, recvChunk), self.MIN_RECV_CHUNK)
+        self.buffer = bytearray(self.recv_chunk)
+        self.buffer_mv = memoryview(self.buffer)
+        self.buffer_pos = 0
+        self.buffer_end = 0
+        self.io_buf = bytearray(self.max_read_size)
+        self.io_mv = memoryview(self.io_buf)
+        self.out = bytearray()
+        self.pin_values = bytearray(255)
+        self.pin_values_mv = memoryview(self.pin_values)
         self.client = False
-        self.pins = {}
+        self.read_poller = select.poll()
+        self.write_poller = select.poll()
+        self._API_VERSION_RESP = bytes((self.apiVerson,))
+        self.pins = [0] * self.NUM_PINS
         self.init_spi()
+        self.init_pins()
+        self.dispatch = (
+            self.cmd_set_pin_single,
+            self.cmd_set_pin_multi,
+            self.cmd_write_bytes,
+            self.cmd_get_pin_single,
+            self.cmd_get_pin_multi,
+            self.cmd_delay,
+            self.cmd_wait_for_pin,
+            self.cmd_get_name,
+            self.cmd_get_api_version,
+        )
 
     def init_spi(self):
         pass
 
+    def init_pins(self):
+        pass
+
     def close(self):
         pass
 
@@ -50,6 +87,8 @@ class PicoGpioNetDaemon():
     def open_socket(self, ip, port):
         address = (ip, port)
         connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.max_read_size * 2)
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 64 * 1024)
         connection.bind(address)
         connection.listen(1)
         return connection
@@ -64,194 +103,226 @@ class PicoGpioNetDaemon():
 
             print("Awaiting connection")
             (clientsocket, address) = serversocket.accept()
+            clientsocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            clientsocket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             self.client = clientsocket
-            self.buffer = bytearray()
-
-            while True:
-                try:
-                    result = self.run_command()
-                    self.client.send(result)
-                except Exception as e:
-                    print(e)
-                    self.client.close()
-                    break
+            clientsocket.setblocking(False)
+            self.read_poller.register(clientsocket, select.POLLIN)
+            self.write_poller.register(clientsocket, select.POLLOUT)
+            self.buffer_pos = 0
+            self.buffer_end = 0
+            self.out[:] = b''
+
+            try:
+                while True:
+                    self.run_command()
+                    if self.buffer_end == self.buffer_pos:
+                        self.send_all(self.out)
+                        self.out[:] = b''
+            except Exception as e:
+                print(e)
+                self.read_poller.unregister(self.client)
+                self.write_poller.unregister(self.client)
+                self.client.close()
 
     def run_command(self):
 
-        print("Awaiting command")
+        if DEBUG:
+            print("Awaiting command")
 
-        command = self.take_from_buffer_single(1)[0]
+        command = self._read_byte()
 
         #print(f"Command {command}")
 
-        if command == self.CMD_SET_PIN_SINGLE:
-            
-            self.cmd_set_pin_single()
-
-        elif command == self.CMD_SET_PIN_MULTI:
-            
-            self.cmd_set_pin_multi()
-
-        elif command == self.CMD_WRITE_BYTES:
-
-            self.cmd_write_bytes()
-
-        elif command == self.CMD_GET_PIN_SINGLE:
-
-            value = self.cmd_get_pin_single()
-            return bytearray([value])
-
-        elif command == self.CMD_GET_PIN_MULTI:
-
-            return self.cmd_get_pin_multi()
-
-        elif command == self.CMD_DELAY:
-
-            self.cmd_delay()
-
-        elif command == self.CMD_WAIT_FOR_PIN:
-
-            self.cmd_wait_for_pin()
-
-        elif command == self.CMD_GET_NAME:
-
-            return self.cmd_get_name()
-
-        elif command == self.CMD_GET_API_VERSION:
-
-            return bytearray([self.apiVerson])
+        if command >= len(self.dispatch):
+            raise ValueError(f'Unknown command {command}')
 
+        result = self.dispatch[command]()
+        if result is None:
+            self.out.append(1)
         else:
+            self.out += result
 
-            print("Unknown")
-        
-        return bytearray([1])
+    def cmd_get_api_version(self):
+        return self._API_VERSION_RESP
 
     def cmd_delay(self):
-        print("Delay")
+        if DEBUG:
+            print("Delay")
 
-        delay_ms = self.read_length_header(2)
+        delay_ms = self._hdr2()
         delay_seconds = float(delay_ms) / 1000.0
 
-        print(f"Seconds: {delay_seconds}")
+        if DEBUG:
+            print(f"Seconds: {delay_seconds}")
         sleep(delay_seconds)
 
     def cmd_wait_for_pin(self):
 
-        print("Wait for pin")
+        if DEBUG:
+            print("Wait for pin")
 
-        data = self.take_from_buffer_single(2)
+        data = self._read_exact(2)
         pin = data[0]
         value = data[1]
-        delay_ms = self.read_length_header(2)
-        delay_seconds = float(delay_ms) / 1000.0
+        delay_ms = self._hdr2()
+        delay_seconds = delay_ms * 0.001
 
-        while False:
+        # Nothing else changes the mock pins while we wait, so only
+        # check the pin once instead of waiting forever.
+        if self.pins[pin] != value:
             sleep(delay_seconds)
 
     def cmd_write_bytes(self):
-        print("Write bytes")
-        numberOfBytes = self.read_length_header(4)
-        for byteArray in self.take_from_buffer(numberOfBytes):
-            pass
+        if DEBUG:
+            print("Write bytes")
+        numberOfBytes = self._hdr4()
+
+        buffered = min(numberOfBytes, self.buffer_end - self.buffer_pos)
+        self.buffer_pos += buffered
+
+        remaining = numberOfBytes - buffered
+        chunkSize = len(self.io_buf)
+        while remaining > 0:
+            length = self.recv_into(self.io_mv[:min(remaining, chunkSize)])
+            remaining -= length
 
     def read_spi(self, numberOfBytes):
         return numberOfBytes * [0]
 
     def cmd_set_pin_single(self):
 
-        print("Set pin")
+        if DEBUG:
+            print("Set pin")
 
         # 1 byte. max size: 255
-        pair = self.take_from_buffer_single(2)
+        pair = self._read_exact(2)
 
         self.set_pin(pair)
 
     def cmd_set_pin_multi(self):
 
-        print("Set pins")
-        numberOfPairs = self.read_length_header(1)
+        if DEBUG:
+            print("Set pins")
+        numberOfPairs = self._hdr1()
         numberOfBytes = numberOfPairs * 2
 
-        for pairs in self.take_from_buffer(numberOfBytes):
-            length = len(pairs)
-            for i in range(0, length, 2):
-                self.set_pin(pairs[i:i+2])
+        pairs = self._read_exact(numberOfBytes)
+        pins = self.pins
+        for i in range(0, numberOfBytes, 2):
+            pins[pairs[i]] = pairs[i + 1]
 
     def set_pin(self, pair):
         pin = pair[0]
         value = pair[1]
-        print(f"Setting pin {pin} to {value}")
-        self.cache_pin(pin)
+        if DEBUG:
+            print(f"Setting pin {pin} to {value}")
         self.pins[pin] = value
 
-    def cache_pin(self, pin):
-        if pin not in self.pins:
-            self.pins[pin] = 0
-
     def cmd_get_pin_multi(self):
 
-        print("Get pins")
-        numberOfBytes = self.read_length_header(1)
-        returnData = bytearray()
-        for byteArray in self.take_from_buffer(numberOfBytes):
-            for pin in byteArray:
-                v = self.get_pin(pin)
-                returnData.append(v)
-        return returnData
+        if DEBUG:
+            print("Get pins")
+        numberOfBytes = self._hdr1()
+        pins = self._read_exact(numberOfBytes)
+
+        returnData = self.pin_values
+        for i in range(numberOfBytes):
+            returnData[i] = self.get_pin(pins[i])
+        return self.pin_values_mv[:numberOfBytes]
 
     def cmd_get_pin_single(self):
-        print("Get pin single")
-        pin = self.take_from_buffer_single(1)
-        return self.get_pin(pin[0])
+        if DEBUG:
+            print("Get pin single")
+        pin = self._read_byte()
+        return self._PIN_RESPONSES[self.get_pin(pin)]
 
     def get_pin(self, pin):
-        print(f"Getting pin {pin}")
-        self.cache_pin(pin)
+        if DEBUG:
+            print(f"Getting pin {pin}")
         return self.pins[pin]
 
     def cmd_get_name(self):
-        print(f"Get name ({self.name})")
+        if DEBUG:
+            print(f"Get name ({self.name})")
         nameBytes = self.name.encode()
         nameLength = len(nameBytes)
         nameLengthBytes = nameLength.to_bytes()
         return nameLengthBytes + nameBytes
 
     def read_length_header(self, numberOfBytes):
-        request = self.take_from_buffer_single(numberOfBytes)
-        request = bytearray(request)
+        if numberOfBytes == 1:
+            return self._hdr1()
+        if numberOfBytes == 2:
+            return self._hdr2()
+        if numberOfBytes == 4:
+            return self._hdr4()
+        request = self._read_exact(numberOfBytes)
         intvalue = int.from_bytes(request, 'big')
         return intvalue
 
+    def _hdr1(self):
+        return self._read_byte()
+
+    def _hdr2(self):
+        b = self._read_exact(2)
+        return (b[0] << 8) | b[1]
+
+    def _hdr4(self):
+        b = self._read_exact(4)
+        return (b[0] << 24) | (b[1] << 16) | (b[2] << 8) | b[3]
+
     def read_into_buffer(self):
-        bytesRead = self.client.recv(self.max_read_size)
-        length = len(bytesRead)
-        if length == 0:
-            raise ValueError('Socket connection closed')
-        self.buffer.extend(bytesRead)
-        print(f"Read {length} bytes")
-
-    def take_from_buffer_single(self, numberOfBytes):
-        returnData = bytearray()
-        for loopBytes in self.take_from_buffer(numberOfBytes):
-            returnData.extend(loopBytes)
-        return returnData
-
-    def take_from_buffer(self, numberOfBytes):
-        returnedBytes = 0
-        while returnedBytes < numberOfBytes:
-
-            remaining = numberOfBytes - returnedBytes
-            bufferLength = len(self.buffer)
-
-            if bufferLength == 0:
-                self.read_into_buffer()
-                bufferLength = len(self.buffer)
-
-            bytesToRead = min(remaining, bufferLength)
-            returnedBytes += bytesToRead
-            yield self.buffer[:bytesToRead]
-            self.buffer = self.buffer[bytesToRead:]
+        capacity = len(self.buffer)
+        if self.buffer_pos == self.buffer_end:
+            self.buffer_pos = 0
+            self.buffer_end = 0
+        elif self.buffer_end == capacity or self.buffer_pos > capacity // 2:
+            unread = self.buffer[self.buffer_pos:self.buffer_end]
+            self.buffer_end = len(unread)
+            self.buffer[:self.buffer_end] = unread
+            self.buffer_pos = 0
+        free = capacity - self.buffer_end
+        if free == 0:
+            raise ValueError('Receive buffer full')
+        length = self.recv_into(self.buffer_mv[self.buffer_end:])
+        self.buffer_end += length
+        if DEBUG:
+            print(f"Read {length} bytes")
+
+    def recv_into(self, view):
+        while True:
+            self.read_poller.poll()
+            try:
+                length = self.client.recv_into(view)
+            except BlockingIOError:
+                continue
+            if length == 0:
+                raise ValueError('Socket connection closed')
+            return length
+
+    def send_all(self, data):
+        view = memoryview(data)
+        sent = 0
+        while sent < len(view):
+            try:
+                sent += self.client.send(view[sent:])
+            except BlockingIOError:
+                self.write_poller.poll()
+
+    def _read_exact(self, numberOfBytes):
+        while self.buffer_end - self.buffer_pos < numberOfBytes:
+            self.read_into_buffer()
+        start = self.buffer_pos
+        self.buffer_pos += numberOfBytes
+        return self.buffer_mv[start:self.buffer_pos]
+
+    def _read_byte(self):
+        while self.buffer_end == self.buffer_pos:
+            self.read_into_buffer()
+        value = self.buffer[self.buffer_pos]
+        self.buffer_pos += 1
+        return value
 
 httpd = PicoGpioNetDaemon(
     ssid = '',
@@ -1,8 +1,24 @@
 import network
-import usocket
-from time import sleep
+try:
+    import usocket
+except ImportError:
+    # Newer MicroPython firmware drops the u-prefixed module names
+    import socket as usocket
+import select
+import errno
+import time
+import gc
+import micropython
 import machine
 from machine import SPI, Pin
+from micropython import const
+
+# Set to 1 to print a message for every command and socket read.
+# Printing is slow on a Pico, so this is off by default.
+# It's declared with const() so that the compiler drops every
+# `if DEBUG:` block entirely when it's off, f-strings and all.
+DEBUG = const(0)
+
 
 class PicoGpioNetDaemon():
 
@@ -58,22 +74,134 @@ class PicoGpioNetDaemon():
     CMD_GET_NAME = 7
     CMD_GET_API_VERSION = 8
 
+    # How long to wait for a wifi connection attempt before retrying
+    CONNECT_TIMEOUT_MS = 30000
+
+    # Smallest allowed receive buffer size.
+    # This fits the 1 byte command, 1 byte length, and 510 bytes of
+    # pin/value pairs of the largest CMD_SET_PIN_MULTI.
+    MIN_RECV_CHUNK = 512
 
+    # Number of GPIO pins on the RP2040 (GP0 to GP29).
+    # Requests for pins outside of this range will fail.
+    NUM_PINS = 30
 
-    def __init__(self, ssid, password, maxSizeKb, name):
+    # Responses for CMD_GET_PIN_SINGLE, indexed by the pin's value.
+    # Pin.value() only ever returns 0 or 1, so these two cover every
+    # possible response.
+    _PIN_RESPONSES = (b'\x00', b'\x01')
+
+
+    def __init__(self, ssid, password, maxSizeKb, name, recvChunk = 2048, outPins = (), inPins = (), spiBaudrate = 24_000_000):
         self.ssid = ssid
         self.password = password
         self.name = name
 
+        # Clock rate of the SPI bus, in Hz.
+        # This sets the upper limit on how fast CMD_WRITE_BYTES can
+        # stream data. The RP2040 can go as high as ~62.5MHz, but the
+        # usable rate depends on the device and wiring, so lower this if
+        # writes come out garbled.
+        self.spi_baudrate = spiBaudrate
+
+        # Pins which are known to be outputs and inputs respectively.
+        # These are set up by init_pins when the daemon starts, rather
+        # than when a client first uses them.
+        self.out_pins = outPins
+        self.in_pins = inPins
+
         # Maximum number of bytes to read in a single loop iteration.
         # The Pi Pico has 264kB of SRAM, so let's make it smaller than that...
+        # This is the chunk size used when streaming CMD_WRITE_BYTES
+        # payloads to SPI.
         self.max_read_size = 1024 * maxSizeKb
 
-        self.buffer = bytearray()
+        # Size of the receive buffer used for commands.
+        # Commands are small, and a recv rarely returns more than a
+        # couple of TCP segments (~1460 bytes each) at a time, so a
+        # buffer the size of max_read_size would mostly go unused.
+        # It must be able to hold the largest command which is read in
+        # one piece, which is a CMD_SET_PIN_MULTI with 255 pairs.
+        self.recv_chunk = max(min(self.max_read_size, recvChunk), self.MIN_RECV_CHUNK)
+
+        # Fixed-size receive buffer.
+        # It's allocated once and reused for every client, so memory
+        # use stays the same no matter how much data is sent.
+        self.buffer = bytearray(self.recv_chunk)
+
+        # View of self.buffer, created once so that slicing the buffer
+        # doesn't allocate a new memoryview every time.
+        self.buffer_mv = memoryview(self.buffer)
+
+        # Position in self.buffer of the next byte to be consumed.
+        # Bytes before this position have already been handled, and
+        # are only discarded when more data is read from the socket.
+        self.buffer_pos = 0
+
+        # Position in self.buffer after the last byte received.
+        # Bytes between buffer_pos and buffer_end are waiting to be
+        # consumed.
+        self.buffer_end = 0
+
+        # Preallocated buffer used to stream CMD_WRITE_BYTES payloads
+        # from the socket straight to SPI, without allocating a new
+        # bytes object for every chunk.
+        self.io_buf = bytearray(self.max_read_size)
+        self.io_mv = memoryview(self.io_buf)
+
+        # Responses which haven't been sent to the client yet
+        self.out = bytearray()
+
+        # Preallocated response for CMD_GET_PIN_MULTI, which can read
+        # at most 255 pins at once.
+        # Responses are copied into self.out straight away, so the same
+        # buffer can be reused by every request.
+        self.pin_values = bytearray(255)
+        self.pin_values_mv = memoryview(self.pin_values)
+
         self.client = False
 
-        self.pins = {}
+        # Pollers used to wait for the client socket to become
+        # readable or writable.
+        self.read_poller = select.poll()
+        self.write_poller = select.poll()
+
+        # Return the API version as a single byte.
+        # This should probably be sent as 2 or more bytes for the sake
+        # of future expansion.
+        # But I doubt that the API version will ever grow large enough
+        # for that to be a problem, so... 1 byte it is.
+        self._API_VERSION_RESP = bytes((self.apiVersion,))
+
+        # Cache of Pin objects, indexed by pin number.
+        # A list is used instead of a dict since the pin numbers are
+        # small and known in advance, so lookups don't need hashing.
+        # Pins which haven't been used yet are None.
+        self.pins = [None] * self.NUM_PINS
+
+        # Mode (Pin.IN or Pin.OUT) of each pin which was created by the
+        # cache_pin_* functions, since Pin objects can't report their
+        # own mode.
+        # Pins set up some other way (eg. in init_spi) are None here,
+        # and are left configured as they are.
+        self.pin_modes = [None] * self.NUM_PINS
         self.init_spi()
+        self.init_pins()
+
+        # Command handlers, indexed by command byte.
+        # This must stay in the same order as the CMD_* values above.
+        # Handlers which return None are responded to with [1].
+        self.dispatch = (
+            self.cmd_set_pin_single,
+            self.cmd_set_pin_multi,
+            self.cmd_write_bytes,
+            self.cmd_get_pin_single,
+            self.cmd_get_pin_multi,
+            self.cmd_delay,
+            self.cmd_wait_for_pin,
+            self.cmd_get_name,
+            self.cmd_get_api_version,
+        )
 
     """
         Setup pins as needed and initialize SPI device.
@@ -85,7 +213,25 @@ class PicoGpioNetDaemon():
         and why you might do this.
     """
     def init_spi(self):
-        self.spi = machine.SPI(1, baudrate=4000_000)
+        self.spi = machine.SPI(1, baudrate=self.spi_baudrate)
+
+    """
+        Creates the Pin objects for the pins passed to the constructor
+        as outPins and inPins.
+
+        Otherwise pins are created the first time a client uses them,
+        which makes that first request noticeably slower than the
+        rest.
+
+        This runs after init_spi, and pins which init_spi has already
+        set up are left as they are.
+        Like init_spi, it can be overridden by a subclass.
+    """
+    def init_pins(self):
+        for pin in self.out_pins:
+            self.cache_pin_out(pin)
+        for pin in self.in_pins:
+            self.cache_pin_in(pin)
 
     """
         Release the SPI interface, pins, and any other resources
@@ -101,17 +247,38 @@ class PicoGpioNetDaemon():
 
         This function will continue trying to connect indefinitely
         until it succeeds.
+        If the connection attempt fails, or takes longer than
+        CONNECT_TIMEOUT_MS, it starts a new attempt.
     """
     def connect(self):
         #Connect to WLAN
         wlan = network.WLAN(network.STA_IF)
         wlan.active(True)
         wlan.connect(self.ssid, self.password)
-        while wlan.isconnected() == False:
-            print('Waiting for connection...')
-            sleep(1)
-        print(wlan.ifconfig())
-        ip = wlan.ifconfig()[0]
+        print('Waiting for connection...')
+
+        # Check the connection state often at first, since connecting
+        # usually only takes a fraction of a second, then back off.
+        delay_ms = 50
+        deadline = time.ticks_add(time.ticks_ms(), self.CONNECT_TIMEOUT_MS)
+        while not wlan.isconnected():
+
+            # Negative statuses mean the attempt failed.
+            # eg. wrong password, or network not found
+            status = wlan.status()
+            if status < 0 or time.ticks_diff(deadline, time.ticks_ms()) <= 0:
+                print(f'Connection failed ({status}), retrying...')
+                wlan.disconnect()
+                wlan.connect(self.ssid, self.password)
+                delay_ms = 50
+                deadline = time.ticks_add(time.ticks_ms(), self.CONNECT_TIMEOUT_MS)
+
+            time.sleep_ms(delay_ms)
+            delay_ms = min(delay_ms * 2, 1000)
+
+        ifconfig = wlan.ifconfig()
+        print(ifconfig)
+        ip = ifconfig[0]
         print(f'Connected on {ip}')
         return ip
 
@@ -142,6 +309,16 @@ class PicoGpioNetDaemon():
         # Open a socket connection
         serversocket = self.open_socket(ip, port)
 
+        # All of the buffers are allocated up front in __init__ and
+        # reused for every client, so the heap shouldn't change much
+        # from here on.
+        # Clean up whatever was left over from startup, then have the
+        # GC run early and often (once a quarter of the free memory has
+        # been allocated) instead of waiting until the heap is full,
+        # which helps to avoid fragmentation.
+        gc.collect()
+        gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+
         print("Serving data")
         while True:
 
@@ -152,97 +329,109 @@ class PicoGpioNetDaemon():
             
             # Client has connected
             self.client = clientsocket
+
+            # Disable Nagle's algorithm, so that batched responses are
+            # sent as soon as they're ready.
+            # Not every MicroPython build supports this option.
+            try:
+                clientsocket.setsockopt(usocket.IPPROTO_TCP, usocket.TCP_NODELAY, 1)
+            except (AttributeError, OSError):
+                pass
+
+            # Use the socket in non-blocking mode, and wait for it to
+            # become ready with poll() instead of blocking inside
+            # recv or send. This also lets reads return whatever data
+            # is available straight into our own buffer.
+            clientsocket.setblocking(False)
+            self.read_poller.register(clientsocket, select.POLLIN)
+            self.write_poller.register(clientsocket, select.POLLOUT)
             
             # Flush the buffer, in case of previous connection aborting
-            self.buffer = bytearray()
+            self.buffer_pos = 0
+            self.buffer_end = 0
+            self.out[:] = b''
 
             # Wait indefinitely for data from the client.
             # Stop if the client disconnects, or if execution is
             # interrupted.
-            while True:
-                try:
-
-                    # Perform a command in response to data from the client
-                    result = self.run_command()
-
-                    # Send a response to the client
-                    self.client.send(result)
-
-                except Exception as e:
-                    print(e)
-
-                    # Close the socket connection
-                    self.client.close()
-
-                    # Break the while loop and wait for a new client
-                    break
+            #
+            # The try block wraps the whole loop rather than each
+            # command, since any error ends the connection anyway.
+            # "No data yet" (EAGAIN) never reaches here; it's handled
+            # by recv_into and send_all, which wait on the pollers.
+            try:
+                while True:
+
+                    # Perform a command in response to data from the client.
+                    # Its response is appended to self.out.
+                    self.run_command()
+
+                    # Send the responses to the client once every command
+                    # we've received so far has been handled.
+                    # Clients usually send many commands at once, so this
+                    # sends all of their responses in one go instead of
+                    # one small packet per command.
+                    if self.buffer_end == self.buffer_pos:
+                        self.send_all(self.out)
+
+                        # Empty the buffer in place, so it's reused for
+                        # the next batch of responses.
+                        # MicroPython bytearrays don't support `del` on
+                        # a slice, so assign an empty slice instead.
+                        self.out[:] = b''
+
+            except Exception as e:
+                print(e)
+
+                # Close the socket connection, then wait for a new client
+                self.read_poller.unregister(self.client)
+                self.write_poller.unregister(self.client)
+                self.client.close()
 
     """
         This function waits for byte data from a client and
         handles the data accordingly by calling the expected
         function.
 
-        It returns a byte array, which is sent back to the client.
+        The command's response is appended to self.out, which is
+        sent back to the client by run_daemon.
+
+        This runs once per command, so it's compiled to native code.
     """
+    @micropython.native
     def run_command(self):
 
-        print("Awaiting command")
+        if DEBUG:
+            print("Awaiting command")
 
-        command = self.take_from_buffer_single(1)[0]
+        command = self._read_byte()
 
         #print(f"Command {command}")
 
-        if command == self.CMD_SET_PIN_SINGLE:
-            
-            self.cmd_set_pin_single()
-
-        elif command == self.CMD_SET_PIN_MULTI:
-            
-            self.cmd_set_pin_multi()
-
-        elif command == self.CMD_WRITE_BYTES:
-
-            self.cmd_write_bytes()
-
-        elif command == self.CMD_GET_PIN_SINGLE:
-
-            result = self.cmd_get_pin_single()
-            return bytearray([result])
-
-        elif command == self.CMD_GET_PIN_MULTI:
-
-            return self.cmd_get_pin_multi()
-
-        elif command == self.CMD_DELAY:
-
-            self.cmd_delay()
+        # An unknown command means we've lost track of where commands
+        # start and end (or the client is talking a newer API), so the
+        # bytes after it can't be trusted either.
+        # Give up on the connection instead of trying to carry on.
+        if command >= len(self.dispatch):
+            raise ValueError(f'Unknown command {command}')
 
-        elif command == self.CMD_WAIT_FOR_PIN:
-
-            self.cmd_wait_for_pin()
-
-        elif command == self.CMD_GET_NAME:
-
-            return self.cmd_get_name()
-
-        elif command == self.CMD_GET_API_VERSION:
-
-            # Return the API version as a single byte.
-            # This should probably be sent as 2 or more bytes for the sake
-            # of future expansion.
-            # But I doubt that the API version will ever grow large enough
-            # for that to be a problem, so... 1 byte it is.
-            return bytearray([self.apiVersion])
+        result = self.dispatch[command]()
 
+        if result is None:
+            # Default response.
+            # Most of these functions write values instead of reading them,
+            # so we just send a single byte to say we're done.
+            self.out.append(1)
         else:
+            self.out += result
 
-            print("Unknown")
-            #TODO: raise exception
-        
-        # Default return value.
-        # Most of these functions write values instead of reading them,
-        # so we just return a single byte to say we're done.
-        return bytearray([1])
+    """
+        CMD_GET_API_VERSION
+
+        Returns the API version as a single byte.
+    """
+    def cmd_get_api_version(self):
+        return self._API_VERSION_RESP
 
     """
         CMD_DELAY
@@ -270,14 +459,18 @@ class PicoGpioNetDaemon():
         before moving on to the next command.
     """
     def cmd_delay(self):
-        print("Delay")
+        if DEBUG:
+            print("Delay")
 
         # 2 bytes. max size: 65535
-        delay_ms = self.read_length_header(2)
-        delay_seconds = float(delay_ms) / 1000.0
+        delay_ms = self._hdr2()
+
+        if DEBUG:
+            print(f"Milliseconds: {delay_ms}")
 
-        print(f"Seconds: {delay_seconds}")
-        sleep(delay_seconds)
+        # Sleep for a whole number of milliseconds, rather than
+        # converting to float seconds first
+        time.sleep_ms(delay_ms)
 
     """
         CMD_WAIT_FOR_PIN
@@ -305,21 +498,32 @@ class PicoGpioNetDaemon():
 
         So in this example, we wait for pin 8 to have a value of 1.
         We re-check the pin every 517 milliseconds until the value is 1.
+
+        A delay of 0 re-checks the pin continuously, without sleeping
+        in between. This responds to the pin change as fast as possible,
+        at the cost of keeping the CPU busy while waiting.
     """
     def cmd_wait_for_pin(self):
 
-        print("Wait for pin")
+        if DEBUG:
+            print("Wait for pin")
 
-        data = self.take_from_buffer_single(2)
+        data = self._read_exact(2)
         pin = data[0]
         value = data[1]
 
         # 2 bytes. max size: 65535
-        delay_ms = self.read_length_header(2)
-        delay_seconds = float(delay_ms) / 1000.0
-
-        while self.get_pin(pin) != value:
-            sleep(delay_seconds)
+        delay_ms = self._hdr2()
+
+        # Look the pin up once, rather than on every check
+        pinObj = self.cache_pin_in(pin)
+        if delay_ms == 0:
+            # Busy-wait, so that short pulses aren't missed while asleep
+            while pinObj.value() != value:
+                pass
+        else:
+            while pinObj.value() != value:
+                time.sleep_ms(delay_ms)
 
     """
         CMD_WRITE_BYTES
@@ -342,17 +546,36 @@ class PicoGpioNetDaemon():
         which equals 1024 when converted to a big-endian int.
         The remaining bytes, which should be 1024 in length, are the data
         to write to spidev.
+
+        Any of the data which has already been read into the buffer is
+        written first. The rest is read from the socket in chunks of up
+        to max_read_size bytes into self.io_buf, and each chunk is
+        written to spidev directly from there.
     """
     def cmd_write_bytes(self):
 
-        print("Write bytes")
+        if DEBUG:
+            print("Write bytes")
 
         # 4 bytes. max size: 4,294,967,295
-        numberOfBytes = self.read_length_header(4)
+        numberOfBytes = self._hdr4()
 
         #print(f"Writing {numberOfBytes} bytes")
-        for byteArray in self.take_from_buffer(numberOfBytes):
-            self.spi.write(byteArray)
+
+        # Write whatever part of the payload is already buffered
+        start = self.buffer_pos
+        buffered = min(numberOfBytes, self.buffer_end - start)
+        if buffered > 0:
+            self.buffer_pos += buffered
+            self.spi.write(self.buffer_mv[start:self.buffer_pos])
+
+        # Stream the remainder through io_buf
+        remaining = numberOfBytes - buffered
+        chunkSize = len(self.io_buf)
+        while remaining > 0:
+            length = self.recv_into(self.io_mv[:min(remaining, chunkSize)])
+            self.spi.write(self.io_mv[:length])
+            remaining -= length
 
         #print(f"Finished writing")
 
@@ -372,10 +595,11 @@ class PicoGpioNetDaemon():
     """
     def cmd_set_pin_single(self):
 
-        print("Set pin")
+        if DEBUG:
+            print("Set pin")
 
         # 1 byte. max size: 255
-        pair = self.take_from_buffer_single(2)
+        pair = self._read_exact(2)
 
         self.set_pin(pair)
 
@@ -400,20 +624,37 @@ class PicoGpioNetDaemon():
         first is pin 16, change value to 0
         second is pin 18, change value to 1
     """
+    @micropython.native
     def cmd_set_pin_multi(self):
 
-        print("Set pins")
+        if DEBUG:
+            print("Set pins")
 
         # 1 byte. max size: 255
-        numberOfPairs = self.read_length_header(1)
+        numberOfPairs = self._hdr1()
 
         # Read double that, because each pin also has a value paired with it
         numberOfBytes = numberOfPairs * 2
 
-        for pairs in self.take_from_buffer(numberOfBytes):
-            length = len(pairs)
-            for i in range(0, length, 2):
-                self.set_pin(pairs[i:i+2])
+        # Read all of the pairs in one go.
+        # Reading them in chunks could split a pair across two chunks.
+        pairs = self._read_exact(numberOfBytes)
+
+        # This is the inner loop for large pin updates, so set_pin and
+        # the cache_pin_out check are inlined, the pin cache is held in
+        # a local, and the whole function is compiled to native code.
+        pins = self.pins
+        modes = self.pin_modes
+        IN = machine.Pin.IN
+        for i in range(0, numberOfBytes, 2):
+            pin = pairs[i]
+            value = pairs[i + 1]
+            if DEBUG:
+                print(f"Setting pin {pin} to {value}")
+            pinObj = pins[pin]
+            if pinObj is None or modes[pin] == IN:
+                pinObj = self.cache_pin_out(pin)
+            pinObj.value(value)
 
     """
         Sets a pin to the specified value.
@@ -424,14 +665,45 @@ class PicoGpioNetDaemon():
     def set_pin(self, pair):
         pin = pair[0]
         value = pair[1]
-        print(f"Setting pin {pin} to {value}")
+        if DEBUG:
+            print(f"Setting pin {pin} to {value}")
 
-        self.cache_pin(pin)
-        self.pins[pin].value(value)
+        self.cache_pin_out(pin).value(value)
 
-    def cache_pin(self, pin):
-        if pin not in self.pins:
-            self.pins[pin] = machine.Pin(pin)
+    """
+        Returns the Pin object for the given pin number, ready to be
+        written to.
+
+        The pin is created as an output the first time it's used.
+        A pin which was previously created as an input (by reading it)
+        is switched to an output. Otherwise the cached pin is returned
+        as-is, so a pin which is written to repeatedly is only
+        configured once.
+    """
+    def cache_pin_out(self, pin):
+        pinObj = self.pins[pin]
+        if pinObj is None or self.pin_modes[pin] == machine.Pin.IN:
+            pinObj = machine.Pin(pin, machine.Pin.OUT)
+            self.pins[pin] = pinObj
+            self.pin_modes[pin] = machine.Pin.OUT
+        return pinObj
+
+    """
+        Returns the Pin object for the given pin number, ready to be
+        read from.
+
+        The pin is created as an input the first time it's used.
+        A pin which is already in use is returned as-is, so reading an
+        output pin returns the value it was last set to, rather than
+        switching it to an input.
+    """
+    def cache_pin_in(self, pin):
+        pinObj = self.pins[pin]
+        if pinObj is None:
+            pinObj = machine.Pin(pin, machine.Pin.IN)
+            self.pins[pin] = pinObj
+            self.pin_modes[pin] = machine.Pin.IN
+        return pinObj
 
     """
         CMD_GET_PIN_MULTI
@@ -446,19 +718,32 @@ class PicoGpioNetDaemon():
         first pin: 16
         second pin: 18
     """
+    @micropython.native
     def cmd_get_pin_multi(self):
 
-        print("Get pins")
+        if DEBUG:
+            print("Get pins")
 
         # 1 byte. max size: 255
-        numberOfBytes = self.read_length_header(1)
-
-        returnData = bytearray()
-        for byteArray in self.take_from_buffer(numberOfBytes):
-            for pin in byteArray:
-                v = self.get_pin(pin)
-                returnData.append(v)
-        return returnData
+        numberOfBytes = self._hdr1()
+
+        # At most 255 bytes, which always fits in the receive buffer
+        pinNumbers = self._read_exact(numberOfBytes)
+
+        # Same as cmd_set_pin_multi, get_pin is inlined and the pin
+        # cache is held in a local, so each pin is a list lookup and a
+        # value() call.
+        # The values are written into the preallocated pin_values
+        # buffer, so nothing is allocated per pin.
+        returnData = self.pin_values
+        pins = self.pins
+        for i in range(numberOfBytes):
+            pin = pinNumbers[i]
+            pinObj = pins[pin]
+            if pinObj is None:
+                pinObj = self.cache_pin_in(pin)
+            returnData[i] = pinObj.value()
+        return self.pin_values_mv[:numberOfBytes]
 
     """
         CMD_GET_PIN_SINGLE
@@ -469,21 +754,22 @@ class PicoGpioNetDaemon():
 
         Example: [18]
         This request would read a single pin: 18
-        It would then return the state of that pin as an int.
+        It would then return the state of that pin as a single byte.
     """
     def cmd_get_pin_single(self):
 
-        print("Get pin single")
+        if DEBUG:
+            print("Get pin single")
 
         # Pin to read
-        pin = self.take_from_buffer_single(1)
+        pin = self._read_byte()
 
-        return self.get_pin(pin[0])
+        return self._PIN_RESPONSES[self.get_pin(pin)]
 
     def get_pin(self, pin):
-        print(f"Getting pin {pin}")
-        self.cache_pin(pin)
-        return self.pins[pin].value()
+        if DEBUG:
+            print(f"Getting pin {pin}")
+        return self.cache_pin_in(pin).value()
 
     """
         CMD_GET_NAME
@@ -507,7 +793,8 @@ class PicoGpioNetDaemon():
     """
     def cmd_get_name(self):
 
-        print(f"Get name ({self.name})")
+        if DEBUG:
+            print(f"Get name ({self.name})")
 
         # Encode the name as a byte array
         nameBytes = self.name.encode("UTF-8")
@@ -528,15 +815,14 @@ class PicoGpioNetDaemon():
     """
     def read_length_header(self, numberOfBytes):
 
-        #print("Waiting for length bytes")
-        
-        request = self.take_from_buffer_single(numberOfBytes)
-        #print(f"Received {len(request)} bytes")
-        #print(f"Received {request} bytes")
+        if numberOfBytes == 1:
+            return self._hdr1()
+        if numberOfBytes == 2:
+            return self._hdr2()
+        if numberOfBytes == 4:
+            return self._hdr4()
 
-        # Convert from byte[] to bytearray, because micropython
-        # won't let from_bytes work with byte[]
-        request = bytearray(request)
+        request = self._read_exact(numberOfBytes)
 
         # Convert the bytes to an unsigned int
         intvalue = int.from_bytes(request, 'big')
@@ -544,53 +830,146 @@ class PicoGpioNetDaemon():
 
         return intvalue
 
+    """
+        Reads a 1, 2 or 4 byte big-endian header from the socket.
+
+        These are the only header sizes used by the commands, so they
+        each get their own decoder with the shifts written out, rather
+        than going through int.from_bytes.
+    """
+    @micropython.native
+    def _hdr1(self):
+        return self._read_byte()
+
+    @micropython.native
+    def _hdr2(self):
+        b = self._read_exact(2)
+        return (b[0] << 8) | b[1]
+
+    @micropython.native
+    def _hdr4(self):
+        b = self._read_exact(4)
+        return (b[0] << 24) | (b[1] << 16) | (b[2] << 8) | b[3]
+
     """
         Reads a number of bytes from the socket into a buffer.
     """
     def read_into_buffer(self):
 
-        # Cap reads at a maximum size of self.max_read_size
+        # Reads are capped at the free space left in self.buffer.
         # This is because Pi Pico boards have very little RAM.
-        # So we can't necessarily read everything from the buffer
+        # So we can't necessarily read everything from the socket
         # in one go.
-        bytesRead = self.client.recv(self.max_read_size)
-        length = len(bytesRead)
 
-        if length == 0:
-            raise ValueError('Socket connection closed')
-        self.buffer.extend(bytesRead)
-        print(f"Read {length} bytes")
+        capacity = len(self.buffer)
+
+        if self.buffer_pos == self.buffer_end:
+
+            # Everything has been consumed, so start again from the
+            # beginning of the buffer.
+            self.buffer_pos = 0
+            self.buffer_end = 0
+
+        elif self.buffer_end == capacity or self.buffer_pos > capacity // 2:
+
+            # Move the unconsumed bytes to the start of the buffer to
+            # make room. More data is only read once nearly everything
+            # in the buffer has been consumed, so this is at most a
+            # few bytes of a partially received command.
+            unread = self.buffer[self.buffer_pos:self.buffer_end]
+            self.buffer_end = len(unread)
+            self.buffer[:self.buffer_end] = unread
+            self.buffer_pos = 0
+
+        free = capacity - self.buffer_end
+        if free == 0:
+            raise ValueError('Receive buffer full')
+
+        length = self.recv_into(self.buffer_mv[self.buffer_end:])
+        self.buffer_end += length
+        if DEBUG:
+            print(f"Read {length} bytes")
 
     """
-        Takes some bytes from the buffer and returns them.
+        Reads data from the client socket directly into `view`.
 
-        numberOfBytes: the number of bytes to take from the buffer.
+        Waits until some data is available, then reads as much of it
+        as will fit. Returns the number of bytes read.
+
+        view: a memoryview to read the data into.
     """
-    def take_from_buffer_single(self, numberOfBytes):
-        returnData = bytearray()
-        for loopBytes in self.take_from_buffer(numberOfBytes):
-            #print(f"Appending {loopBytes}")
-            returnData.extend(loopBytes)
-        return returnData
+    def recv_into(self, view):
+        while True:
+            self.read_poller.poll()
+
+            # readinto returns None if no data is available yet
+            length = self.client.readinto(view)
+            if length is None:
+                continue
+
+            if length == 0:
+                raise ValueError('Socket connection closed')
+            return length
 
     """
-        Takes some bytes from the buffer and yields them.
+        Sends all of `data` to the client.
+
+        The socket is non-blocking, so a large response may only be
+        partially sent. In that case, wait until the socket is
+        writable again and send the rest.
+    """
+    def send_all(self, data):
+        view = memoryview(data)
+        sent = 0
+        while sent < len(view):
+            try:
+                sent += self.client.send(view[sent:])
+            except OSError as e:
+                if e.args[0] != errno.EAGAIN:
+                    raise
+                self.write_poller.poll()
+
+    """
+        Takes a small, fixed number of bytes from the buffer and
+        returns them.
+
+        This is used for command bytes, headers and other small
+        payloads, which are almost always already in the buffer.
+        It runs for nearly every byte of a command, so it's compiled
+        to native code.
+        In that case it's a single memoryview slice, without copying
+        the bytes.
+
+        The returned view points into self.buffer, so it must be used
+        before anything else is read from the buffer.
 
         numberOfBytes: the number of bytes to take from the buffer.
     """
-    def take_from_buffer(self, numberOfBytes):
-        returnedBytes = 0
-        while returnedBytes < numberOfBytes:
+    @micropython.native
+    def _read_exact(self, numberOfBytes):
 
-            remaining = numberOfBytes - returnedBytes
-            bufferLength = len(self.buffer)
+        # Read from the socket until enough bytes are buffered
+        while self.buffer_end - self.buffer_pos < numberOfBytes:
+            self.read_into_buffer()
+
+        start = self.buffer_pos
+        self.buffer_pos += numberOfBytes
+        return self.buffer_mv[start:self.buffer_pos]
+
+    """
+        Takes a single byte from the buffer and returns it as an int.
+
+        This is used for command bytes and 1 byte headers. The byte is
+        read straight out of self.buffer, so unlike _read_exact(1)
+        there's no memoryview slice to allocate.
+    """
+    @micropython.native
+    def _read_byte(self):
 
-            # If the buffer is empty, read more from the socket
-            if bufferLength == 0:
-                self.read_into_buffer()
-                bufferLength = len(self.buffer)
+        # Read from the socket until at least one byte is buffered
+        while self.buffer_end == self.buffer_pos:
+            self.read_into_buffer()
 
-            bytesToRead = min(remaining, bufferLength)
-            returnedBytes += bytesToRead
-            yield self.buffer[:bytesToRead]
-            self.buffer = self.buffer[bytesToRead:]
+        value = self.buffer[self.buffer_pos]
+        self.buffer_pos += 1
+        return value